@@ -1,28 +1,25 @@
 #!/usr/bin/python3
-import json
-import urllib.request
-import sys
-
-# Update these to your local paths
-DATA_SOURCES = {
-    '1090': 'http://localhost/dump1090-fa/',
-    '978': 'http://localhost/skyaware978/'
-}
-
-def get_json(base_url, file):
-    try:
-        with urllib.request.urlopen(base_url + file) as url:#!/usr/bin/python3
 import collections
 from geopy.distance import geodesic
 import json
 import os
+import readsb_history
+import snapshot_cache
 import sys
+import time
 
 # --- Configuration (Direct File Access) ---
 DATA_SOURCES = {
     '1090': '/run/dump1090-fa',
     '978': '/run/skyaware978'
 }
+# Files shared between plugin instances, parsed once via the state-directory cache
+CACHED_FILES = ('stats.json', 'receiver.json')
+
+# readsb + tar1090: compressed history directory per source, e.g. {'1090': '/run/tar1090'};
+# sources not listed read history_N.json from their DATA_SOURCES directory
+HISTORY_SOURCES = {}
+HISTORY_SECS = 3600 # how far back to read compressed history
 
 CONFIG = {
     'ac': """\
@@ -89,6 +86,8 @@ cpu_978.label dump978-fa
 
 def get_json(path, filename):
     try:
+        if filename in CACHED_FILES:
+            return snapshot_cache.load_json(os.path.join(path, filename))
         with open(os.path.join(path, filename)) as f:
             return json.load(f)
     except: return None
@@ -104,24 +103,29 @@ def do_fetch(which):
         rx_pos = (main_rx['lat'], main_rx['lon']) if main_rx and 'lat' in main_rx else (0,0)
 
         for tech, path in DATA_SOURCES.items():
-            recv = get_json(path, 'receiver.json')
-            if not recv: continue
-            for i in range(int(recv.get('history', 0))):
-                d = get_json(path, f'history_{i}.json')
-                if d:
-                    for ac in d['aircraft']:
-                        if ac['hex'] not in ac_all:
-                            ac_all.add(ac['hex'])
-                            if 'lat' in ac:
-                                n_pos += 1
-                                if rx_pos != (0,0):
-                                    try: dist.append(geodesic(rx_pos, (ac['lat'], ac['lon'])).nm)
-                                    except: pass
-                            if ac.get('alt_baro') == 'ground': n_gnd += 1
-                            else: n_air += 1
-                            if tech == '978':
-                                if ac.get('addr_type') == 1: anon += 1
-                                if 'tisb' in ac.get('type', ''): tis_b += 1
+            if tech in HISTORY_SOURCES:
+                snapshots = [d for _, d in readsb_history.iter_history(HISTORY_SOURCES[tech], time.time() - HISTORY_SECS)]
+            else:
+                recv = get_json(path, 'receiver.json')
+                if not recv: continue
+                snapshots = []
+                for i in range(int(recv.get('history', 0))):
+                    d = get_json(path, f'history_{i}.json')
+                    if d: snapshots.append(d['aircraft'])
+            for aircraft in snapshots:
+                for ac in aircraft:
+                    if ac['hex'] not in ac_all:
+                        ac_all.add(ac['hex'])
+                        if 'lat' in ac:
+                            n_pos += 1
+                            if rx_pos != (0,0):
+                                try: dist.append(geodesic(rx_pos, (ac['lat'], ac['lon'])).nm)
+                                except: pass
+                        if ac.get('alt_baro') == 'ground': n_gnd += 1
+                        else: n_air += 1
+                        if tech == '978':
+                            if ac.get('addr_type') == 1: anon += 1
+                            if 'tisb' in ac.get('type', ''): tis_b += 1
 
         print('multigraph adsb_ac_n')
         print(f'n.value {len(ac_all)}\nn_pos.value {n_pos}\nn_air.value {n_air}\nn_gnd.value {n_gnd}')
@@ -174,73 +178,5 @@ if __name__ == '__main__':
     metric = name.split('_')[-1]
     if len(sys.argv) > 1 and sys.argv[1] == 'config':
         print(CONFIG.get(metric, "graph_title Unknown\n"))
-    else:
-        do_fetch(metric)
-            return json.loads(url.read().decode())
-    except:
-        return None
-
-# --- Configuration with Improved Scaling ---
-CONFIGS = {
-    'ac': """\
-graph_title ADS-B/UAT Aircraft
-graph_category adsb
-graph_vlabel count
-n_air.label Airborne
-n_air.draw AREA
-n_gnd.label Ground
-n_gnd.draw STACK
-n_pos.label With Position
-n_pos.draw LINE2""",
-
-    'health': """\
-graph_title ADS-B Signal Health
-graph_category adsb
-graph_vlabel dBFS
-graph_args --upper-limit 0 --lower-limit -60
-peak.label Peak Signal
-noise.label Noise Floor
-noise.draw LINE2""",
-
-    'msgs': """\
-graph_title ADS-B Message Rates
-graph_category adsb
-graph_vlabel msgs/sec
-m_1090.label 1090MHz
-m_978.label 978MHz (UAT)
-m_978.draw LINE2"""
-}
-
-def do_config(which):
-    print(CONFIGS[which])
-
-def do_fetch(which):
-    if which == 'ac':
-        a = get_json(DATA_SOURCES['1090'], 'aircraft.json')
-        if a:
-            # Count logic
-            air = sum(1 for x in a['aircraft'] if x.get('altitude') != 'ground')
-            gnd = sum(1 for x in a['aircraft'] if x.get('altitude') == 'ground')
-            pos = sum(1 for x in a['aircraft'] if 'lat' in x)
-            print(f"n_air.value {air}\nn_gnd.value {gnd}\nn_pos.value {pos}")
-            
-    elif which == 'health':
-        s = get_json(DATA_SOURCES['1090'], 'stats.json')
-        if s and 'last5min' in s:
-            sig = s['last5min'].get('local', {})
-            print(f"peak.value {sig.get('peak_signal', 'U')}")
-            print(f"noise.value {sig.get('noise', 'U')}")
-
-    elif which == 'msgs':
-        s1090 = get_json(DATA_SOURCES['1090'], 'stats.json')
-        s978 = get_json(DATA_SOURCES['978'], 'stats.json')
-        v1090 = s1090['last5min']['local']['accepted'][0] / 300 if s1090 else "U"
-        v978 = s978['last5min']['local']['accepted'][0] / 300 if s978 else "U"
-        print(f"m_1090.value {v1090}\nm_978.value {v978}")
-
-if __name__ == "__main__":
-    metric = sys.argv[0].split('_')[-1]
-    if len(sys.argv) > 1 and sys.argv[1] == 'config':
-        do_config(metric)
     else:
         do_fetch(metric)
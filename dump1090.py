@@ -6,12 +6,19 @@
 # https://github.com/strix-technica/ADSB-tools
 
 import collections
+import heapq
 from geopy.distance import geodesic
 import json
+import math
+import munin_spool
 import os
+import readsb_history
+import snapshot_cache
 import sys
+import time
 
 KM_PER_FT = 0.0003048
+EARTH_RADIUS_NM = 3440.065
 
 # --- Configuration begins ---
 RX_ALT_KM = KM_PER_FT * 108 # feet
@@ -21,9 +28,51 @@ JSON_DATA = '/run/dump1090-fa'
 STATS_FILE = os.path.join(JSON_DATA, 'stats.json')
 RECVR_FILE = os.path.join(JSON_DATA, 'receiver.json')
 
+# readsb + tar1090: set this to tar1090's directory (e.g. '/run/tar1090') to
+# read its compressed chunk_*.gz/*.binCraft history instead of dump1090-fa's
+# history_N.json files in JSON_DATA. tar1090 snapshots come every ~8 s rather
+# than every 30 s, so the last 10 snapshots used for the ac counts, ALT_HIST
+# climb/descent classification and message rates span about 80 s, not 5 minutes.
+HISTORY_DATA = None
+# Compressed history older than this (s) is only read if the accumulators need it
+HISTORY_WINDOW = 600
+
 # altitude hysteresis: a/c are level if alt difference < +- ALT_HIST
 # Set fairly high to distinguish between FL changes and departure/arrivals
 ALT_HIST = 4500
+
+# Persistent accumulator state lives in the Munin plugin state directory
+STATE_FILE = os.path.join(snapshot_cache.STATE_DIR, 'dump1090_ac.json')
+
+# Coverage polar: per-bearing-sector maximum and percentile range, per altitude band
+COV_SECTORS = 36                        # 10 degree sectors
+COV_ALT_BANDS = (0, 10000, 20000, 30000) # band lower bounds, feet
+COV_BIN_NM = 5                          # range histogram bin width
+COV_BINS = 80                           # ranges beyond COV_BINS * COV_BIN_NM share the last bin
+COV_PCT = 90                            # percentile range reported per sector
+# Positions further out than this are bad decodes (e.g. wrong CPR zone), not
+# coverage: the radio horizon for a 45000 ft aircraft is about 260 nm
+COV_MAX_NM = 350
+COV_JSON = os.path.join(snapshot_cache.STATE_DIR, 'dump1090_coverage.json')
+
+# RSSI versus range: decaying range x RSSI histogram, median RSSI per range band
+RSSI_BAND_NM = 25       # range band width; the last band is open-ended
+RSSI_BANDS = 10
+RSSI_BIN_DB = 1
+RSSI_MIN_DB = -50       # bins cover RSSI_MIN_DB..0 dBFS
+RSSI_HALF_LIFE = 86400  # seconds; old samples fade so the medians track the antenna/LNA
+
+# Per-aircraft message rates over the last 10 snapshots
+TOP_K = 5               # busiest aircraft whose share of traffic is reported
+RATE_MIN = 0.01         # msg/s; lower edge of the log-bucketed rate histogram
+RATE_BUCKETS = 80       # 4 per octave, up to RATE_MIN * 2**20
+RATE_PER_OCTAVE = 4
+
+# Spool mode: sample every SPOOL_INTERVAL seconds (0 disables) via a
+# separately run `dump1090.py spool`; fetches then drain the spool.
+# See munin_spool.py before enabling it on an existing install.
+SPOOL_INTERVAL = 0
+SPOOL_SLOTS = 65536 # records kept per metric
 # --- Configuration ends ---
 
 CONFIG = {
@@ -136,28 +185,318 @@ single.label Single-point tracks
 }
 
 
+def coverage_config():
+    """Munin config for the coverage polar multigraphs"""
+    sectors = range(0, 360, 360 // COV_SECTORS)
+    fields = ''.join(f's{b:03d}.label {b:03d}°\n' for b in sectors)
+    out = f"""
+multigraph dump1090_ac_coverage
+graph_title ADS-B coverage: maximum range by bearing
+graph_category dump1090
+graph_vlabel nm
+graph_args -l 0
+{fields}
+multigraph dump1090_ac_coverage_pct
+graph_title ADS-B coverage: {COV_PCT}th percentile range by bearing
+graph_category dump1090
+graph_vlabel nm
+graph_args -l 0
+{fields}"""
+    for i, name in enumerate(band_names()):
+        out += f"""
+multigraph dump1090_ac_coverage.{name}
+graph_title ADS-B coverage: maximum range by bearing, {band_label(i)}
+graph_category dump1090
+graph_vlabel nm
+graph_args -l 0
+{fields}"""
+    return out
+
+
+def band_names():
+    return [f'alt_{lo}' for lo in COV_ALT_BANDS]
+
+
+def band_label(i):
+    if i == len(COV_ALT_BANDS) - 1:
+        return f'above {COV_ALT_BANDS[i]} ft'
+    return f'{COV_ALT_BANDS[i]}-{COV_ALT_BANDS[i + 1]} ft'
+
+
+CONFIG['ac'] += coverage_config()
+
+
+def ranges_bearings(rx_pos, positions):
+    """Great-circle range (nm) and initial bearing (degrees) from rx_pos to each of positions"""
+    lat0, lon0 = math.radians(rx_pos[0]), math.radians(rx_pos[1])
+    sin0, cos0 = math.sin(lat0), math.cos(lat0)
+    ranges, bearings = [], []
+    for lat, lon in positions:
+        lat1 = math.radians(lat)
+        dlon = math.radians(lon) - lon0
+        sin1, cos1 = math.sin(lat1), math.cos(lat1)
+        a = math.sin((lat1 - lat0) / 2) ** 2 + cos0 * cos1 * math.sin(dlon / 2) ** 2
+        ranges.append(2 * EARTH_RADIUS_NM * math.asin(min(1.0, math.sqrt(a))))
+        y = math.sin(dlon) * cos1
+        x = cos0 * sin1 - sin0 * cos1 * math.cos(dlon)
+        bearings.append(math.degrees(math.atan2(y, x)) % 360)
+    return ranges, bearings
+
+
+def load_state():
+    """Load accumulator state, starting afresh if missing or unreadable"""
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'last_ts': 0}
+
+
+def save_state(state, fn=None):
+    """Atomically replace a JSON state file"""
+    fn = fn or STATE_FILE
+    try:
+        snapshot_cache.atomic_write(fn, json.dumps(state))
+    except OSError as e:
+        print(f"Cannot write {fn}: {e}", file=sys.stderr)
+
+
+def position_reports(snapshots):
+    """Positions of all aircraft in snapshots, with altitude (ft) and rssi (None if unknown)"""
+    positions, alts, rssis = [], [], []
+    for ts, d in snapshots:
+        for ac in d:
+            if 'lat' not in ac or 'lon' not in ac:
+                continue
+            alt = ac.get('alt_baro', ac.get('alt_geom'))
+            if alt == 'ground':
+                alt = 0
+            positions.append((ac['lat'], ac['lon']))
+            alts.append(alt if isinstance(alt, (int, float)) else None)
+            rssi = ac.get('rssi')
+            rssis.append(rssi if isinstance(rssi, (int, float)) else None)
+    return positions, alts, rssis
+
+
+def coverage_fold(cov, alts, ranges, bearings):
+    """Fold position reports into the coverage accumulator"""
+    sector_width = 360.0 / COV_SECTORS
+    for alt, rng, brg in zip(alts, ranges, bearings):
+        # All-time maxima never recover from an outlier, so drop implausible ranges
+        if alt is None or rng > COV_MAX_NM:
+            continue
+        band = 0
+        while band + 1 < len(COV_ALT_BANDS) and alt >= COV_ALT_BANDS[band + 1]:
+            band += 1
+        sector = int(brg / sector_width) % COV_SECTORS
+        if rng > cov['max'][band][sector]:
+            cov['max'][band][sector] = rng
+        cov['hist'][band][sector][min(int(rng / COV_BIN_NM), COV_BINS - 1)] += 1
+
+
+def coverage_new():
+    return {
+        'max': [[0.0] * COV_SECTORS for _ in COV_ALT_BANDS],
+        'hist': [[[0] * COV_BINS for _ in range(COV_SECTORS)] for _ in COV_ALT_BANDS],
+    }
+
+
+def coverage_valid(cov):
+    try:
+        return (len(cov['hist']) == len(COV_ALT_BANDS) and
+                len(cov['hist'][0]) == COV_SECTORS and
+                len(cov['hist'][0][0]) == COV_BINS)
+    except (KeyError, IndexError, TypeError):
+        return False
+
+
+def rssi_new():
+    return [[0.0] * (-RSSI_MIN_DB // RSSI_BIN_DB) for _ in range(RSSI_BANDS)]
+
+
+def rssi_valid(hist):
+    try:
+        return len(hist) == RSSI_BANDS and len(hist[0]) == -RSSI_MIN_DB // RSSI_BIN_DB
+    except (IndexError, TypeError):
+        return False
+
+
+def rssi_fold(hist, rssis, ranges, elapsed):
+    """Decay the RSSI histogram by elapsed seconds, then fold in position reports"""
+    decay = 0.5 ** (elapsed / RSSI_HALF_LIFE)
+    for band in hist:
+        for i in range(len(band)):
+            band[i] *= decay
+    n_bins = len(hist[0])
+    for rssi, rng in zip(rssis, ranges):
+        if rssi is None:
+            continue
+        band = min(int(rng / RSSI_BAND_NM), RSSI_BANDS - 1)
+        hist[band][max(0, min(int((rssi - RSSI_MIN_DB) / RSSI_BIN_DB), n_bins - 1))] += 1
+
+
+def rssi_median(counts):
+    """Median RSSI (dBFS) of a histogram row, interpolated within its bin; None if empty"""
+    total = sum(counts)
+    if total < 1:
+        return None
+    seen = 0.0
+    for i, n in enumerate(counts):
+        if n and seen + n >= total / 2.0:
+            return RSSI_MIN_DB + (i + (total / 2.0 - seen) / n) * RSSI_BIN_DB
+        seen += n
+    return 0.0
+
+
+def rssi_config():
+    """Munin config for the RSSI-versus-range multigraph"""
+    fields = ''
+    for band in range(RSSI_BANDS):
+        lo = band * RSSI_BAND_NM
+        label = f'{lo}+ nm' if band == RSSI_BANDS - 1 else f'{lo}-{lo + RSSI_BAND_NM} nm'
+        fields += f'r{lo:03d}.label {label}\n'
+    return f"""
+multigraph dump1090_ac_rssi
+graph_title ADS-B median signal strength by range
+graph_category dump1090
+graph_vlabel dBFS
+graph_info Median RSSI of position reports per range band, decaying with a {RSSI_HALF_LIFE // 3600} h half-life. A drop at long range with unchanged traffic points at the antenna, feeder or LNA.
+{fields}"""
+
+
+CONFIG['ac'] += rssi_config()
+
+
+CONFIG['ac'] += f"""
+multigraph dump1090_ac_msgrate
+graph_title ADS-B per-aircraft message rate
+graph_category dump1090
+graph_vlabel messages/second
+graph_args -l 0
+p50.label Median aircraft
+p90.label 90th percentile aircraft
+p99.label 99th percentile aircraft
+top.label Busiest aircraft
+
+multigraph dump1090_ac_topk
+graph_title ADS-B message share of the {TOP_K} busiest aircraft
+graph_category dump1090
+graph_vlabel %
+graph_args -l 0 -u 100
+share.label Top {TOP_K} share of messages
+"""
+
+
+def message_rates(snapshots):
+    """Per-aircraft message rate (msg/s) from the messages counter of the first and last snapshot each appears in"""
+    first, last = {}, {}
+    for ts, d in snapshots:
+        for ac in d:
+            if isinstance(ac.get('messages'), int):
+                first.setdefault(ac['hex'], (ts, ac['messages']))
+                last[ac['hex']] = (ts, ac['messages'])
+    rates = []
+    for hexid, (ts0, m0) in first.items():
+        ts1, m1 = last[hexid]
+        # counter resets (aircraft timed out and reacquired) would go negative
+        if ts1 > ts0 and m1 >= m0:
+            rates.append((m1 - m0) / (ts1 - ts0))
+    return rates
+
+
+def rate_bucket(rate):
+    if rate < RATE_MIN:
+        return 0
+    return min(int(math.log2(rate / RATE_MIN) * RATE_PER_OCTAVE) + 1, RATE_BUCKETS - 1)
+
+
+def rate_quantile(hist, q):
+    """Approximate q-quantile of a rate histogram: geometric centre of the bucket holding it"""
+    want = sum(hist) * q
+    seen = 0
+    for i, n in enumerate(hist):
+        seen += n
+        if n and seen >= want:
+            if i == 0:
+                return 0.0
+            return RATE_MIN * 2 ** ((i - 0.5) / RATE_PER_OCTAVE)
+    return 0.0
+
+
+def hist_percentile(hist, pct, upper):
+    """Upper edge of the histogram bin holding the pct-th percentile, capped at upper"""
+    total = sum(hist)
+    if not total:
+        return 0.0
+    want = total * pct / 100.0
+    seen = 0
+    for i, n in enumerate(hist):
+        seen += n
+        if seen >= want:
+            return min((i + 1) * COV_BIN_NM, upper)
+    return upper
+
+
+def coverage_report(cov):
+    """Derive per-sector max and percentile range, overall and per altitude band"""
+    all_max = [max(band[s] for band in cov['max']) for s in range(COV_SECTORS)]
+    all_pct = []
+    for s in range(COV_SECTORS):
+        hist = [sum(band[s][i] for band in cov['hist']) for i in range(COV_BINS)]
+        all_pct.append(hist_percentile(hist, COV_PCT, all_max[s]))
+    bands = {}
+    for i, name in enumerate(band_names()):
+        bands[name] = {
+            'label': band_label(i),
+            'max': cov['max'][i],
+            'pct': [hist_percentile(cov['hist'][i][s], COV_PCT, cov['max'][i][s])
+                    for s in range(COV_SECTORS)],
+        }
+    return {
+        'sector_deg': 360.0 / COV_SECTORS,
+        'percentile': COV_PCT,
+        'max': all_max,
+        'pct': all_pct,
+        'bands': bands,
+    }
+
+
 def do_config(which):
     """Output Munin config data"""
-    print(CONFIG[which], end='')
+    if SPOOL_INTERVAL:
+        print(munin_spool.spool_config(CONFIG[which], SPOOL_INTERVAL), end='')
+    else:
+        print(CONFIG[which], end='')
     sys.exit(0)
 
 
-def do_fetch(which):
-    """Output recorded Munin data"""
+def spool_jobs():
+    """Spool sampler jobs covering every metric"""
+    # Sample the 1-minute stats window when spooling finer than 5 minutes
+    window = 60 if SPOOL_INTERVAL < 300 else 300
+    return [(munin_spool.Spool(f'dump1090_{which}', config, SPOOL_SLOTS), do_fetch, (which, window))
+            for which, config in CONFIG.items()]
+
+
+def do_fetch(which, window=300):
+    """Output recorded Munin data; window selects the stats.json period (60, 300 or 900 s)"""
     if which == 'ac':
-        with open(RECVR_FILE) as f:
-            receiver = json.load(f)
-        n_hist = int(receiver['history'])
+        receiver = snapshot_cache.load_json(RECVR_FILE)
         # geodesic doesn't use altitude well in simple distance calcs, so we use lat/lon
         rx_pos = (receiver['lat'], receiver['lon'])
+        state = load_state()
 
         data = []
-        for i in range(n_hist):
-            fn = os.path.join(JSON_DATA, 'history_%s.json' % (i,))
-            if os.path.exists(fn):
-                with open(fn) as f:
-                    d = json.load(f)
-                data.append((d['now'], d['aircraft']))
+        if HISTORY_DATA:
+            since = min(state['last_ts'], time.time() - HISTORY_WINDOW)
+            data = list(readsb_history.iter_history(HISTORY_DATA, since))
+        else:
+            for i in range(int(receiver['history'])):
+                fn = os.path.join(JSON_DATA, 'history_%s.json' % (i,))
+                if os.path.exists(fn):
+                    with open(fn) as f:
+                        d = json.load(f)
+                    data.append((d['now'], d['aircraft']))
         data.sort()
 
         ac_n = set()
@@ -211,24 +550,75 @@ def do_fetch(which):
         print('multigraph dump1090_ac_range')
         print(f'avg_range.value {avg_dist:.1f}')
         print(f'max_range.value {max_dist:.1f}')
+
+        # One pass over the aircraft: heap selection for the top talkers, buckets for the quantiles
+        rates = message_rates(data[-10:])
+        top = heapq.nlargest(TOP_K, rates)
+        rate_hist = [0] * RATE_BUCKETS
+        for rate in rates:
+            rate_hist[rate_bucket(rate)] += 1
+        total = sum(rates)
+
+        print('multigraph dump1090_ac_msgrate')
+        print(f'p50.value {rate_quantile(rate_hist, 0.5):.2f}')
+        print(f'p90.value {rate_quantile(rate_hist, 0.9):.2f}')
+        print(f'p99.value {rate_quantile(rate_hist, 0.99):.2f}')
+        print(f'top.value {top[0] if top else 0:.2f}')
+        print('multigraph dump1090_ac_topk')
+        print(f"share.value {f'{sum(top) / total * 100:.1f}' if total else 'U'}")
+
+        # Coverage and RSSI accumulate across runs: fold in only snapshots not yet seen
+        if not coverage_valid(state.get('coverage')):
+            state['coverage'] = coverage_new()
+        if not rssi_valid(state.get('rssi')):
+            state['rssi'] = rssi_new()
+        new = [(ts, d) for ts, d in data if ts > state['last_ts']]
+        if new:
+            positions, alts, rssis = position_reports(new)
+            ranges, bearings = ranges_bearings(rx_pos, positions)
+            coverage_fold(state['coverage'], alts, ranges, bearings)
+            rssi_fold(state['rssi'], rssis, ranges, new[-1][0] - state['last_ts'])
+            state['last_ts'] = new[-1][0]
+            save_state(state)
+
+        report = coverage_report(state['coverage'])
+        report['now'] = state['last_ts']
+        report['receiver'] = list(rx_pos)
+        save_state(report, COV_JSON)
+
+        sectors = range(0, 360, 360 // COV_SECTORS)
+        print('multigraph dump1090_ac_coverage')
+        for b, v in zip(sectors, report['max']):
+            print(f's{b:03d}.value {v:.1f}')
+        print('multigraph dump1090_ac_coverage_pct')
+        for b, v in zip(sectors, report['pct']):
+            print(f's{b:03d}.value {v:.1f}')
+        for name, band in report['bands'].items():
+            print(f'multigraph dump1090_ac_coverage.{name}')
+            for b, v in zip(sectors, band['max']):
+                print(f's{b:03d}.value {v:.1f}')
+
+        print('multigraph dump1090_ac_rssi')
+        for band, counts in enumerate(state['rssi']):
+            median = rssi_median(counts)
+            print(f"r{band * RSSI_BAND_NM:03d}.value {'U' if median is None else f'{median:.1f}'}")
         return
 
-    # Non-AC metrics (CPU, Messages, etc)
-    with open(STATS_FILE) as f:
-        stats_data = json.load(f)['last5min']
+    # Non-AC metrics (CPU, Messages, etc); these run back to back, so share one parse
+    stats_data = snapshot_cache.load_json(STATS_FILE)[f'last{window // 60}min']
 
     if which == 'cpu':
-        print(f"usb.value {stats_data['cpu']['reader'] / 3000.0:.3f}")
-        print(f"demod.value {stats_data['cpu']['demod'] / 3000.0:.3f}")
-        print(f"bg.value {stats_data['cpu']['background'] / 3000.0:.3f}")
+        print(f"usb.value {stats_data['cpu']['reader'] / (window * 10.0):.3f}")
+        print(f"demod.value {stats_data['cpu']['demod'] / (window * 10.0):.3f}")
+        print(f"bg.value {stats_data['cpu']['background'] / (window * 10.0):.3f}")
 
     elif which == 'messages':
         accepted = stats_data['local']['accepted']
         # Pad list if version of dump1090 provides fewer than 3 indices
         while len(accepted) < 3: accepted.append(0)
-        print(f"good0.value {accepted[0] / 300.0:.1f}")
-        print(f"good1.value {accepted[1] / 300.0:.1f}")
-        print(f"good2.value {accepted[2] / 300.0:.1f}")
+        print(f"good0.value {accepted[0] / float(window):.1f}")
+        print(f"good1.value {accepted[1] / float(window):.1f}")
+        print(f"good2.value {accepted[2] / float(window):.1f}")
 
     elif which == 'quality':
         total = float(stats_data['local']['modes'])
@@ -252,6 +642,10 @@ def do_fetch(which):
 
 
 if __name__ == '__main__':
+    # One sampler covers every metric, so it doesn't need a wildcard symlink
+    if len(sys.argv) == 2 and sys.argv[1] == 'spool':
+        munin_spool.main(spool_jobs(), SPOOL_INTERVAL, None)
+
     # Munin wildcard logic: extract 'messages' from 'dump1090_messages'
     plugin_name = os.path.basename(sys.argv[0])
     try:
@@ -263,4 +657,5 @@ if __name__ == '__main__':
     if len(sys.argv) == 2 and sys.argv[1] == 'config':
         do_config(which_metric)
     else:
-        do_fetch(which_metric)
+        spool = munin_spool.Spool(f'dump1090_{which_metric}', CONFIG[which_metric], SPOOL_SLOTS)
+        munin_spool.main(spool, SPOOL_INTERVAL, lambda: do_fetch(which_metric))
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+# Spooled sub-interval sampling for Munin plugins, in the style of munin-async
+#
+# A scheduler (`<plugin> spool`, run from systemd or similar) samples the
+# plugin's fetch output every SPOOL_INTERVAL seconds into a fixed-size binary
+# ring file in the plugin state directory. The next Munin fetch drains it as
+# timestamped `field.value epoch:value` lines, giving sub-5-minute resolution
+# without munin-node running the plugin more often.
+#
+# Munin only applies the config's update_rate when it creates an RRD: on an
+# existing install, delete the plugin's RRDs on the master (e.g.
+# /var/lib/munin/<domain>/<host>-dump1090_*.rrd) after enabling spooling, or
+# the extra samples are averaged into the old 5-minute steps.
+#
+# The sampler must run as the munin-node plugin user: spool files are created
+# 0644, and a fetch run by any other user cannot drain them (it then falls back
+# to a live fetch).
+
+import contextlib
+import fcntl
+import io
+import math
+import os
+import snapshot_cache
+import struct
+import sys
+import time
+import zlib
+
+# Header: magic, hash of the field list, slot count, records written, records drained
+HDR = struct.Struct('<4sIIQQ')
+# Record: epoch, field index, value (NaN for 'U')
+REC = struct.Struct('<IHd')
+MAGIC = b'MSPL'
+
+
+def config_keys(config):
+    """Ordered (multigraph, field) pairs declared in a Munin config text"""
+    keys = []
+    graph = None
+    for line in config.splitlines():
+        if line.startswith('multigraph '):
+            graph = line.split(None, 1)[1].strip()
+        elif '.label ' in line:
+            keys.append((graph, line.split('.', 1)[0]))
+    return keys
+
+
+def spool_config(config, interval):
+    """Add update_rate to every graph in config so RRDs keep the finer samples"""
+    out = []
+    for line in config.splitlines(True):
+        out.append(line)
+        if line.startswith('graph_title '):
+            out.append(f'update_rate {interval}\n')
+    return ''.join(out)
+
+
+class Spool(object):
+    """Append-only ring of (epoch, field, value) records, locked with flock"""
+    def __init__(self, name, config, slots):
+        self.path = os.path.join(snapshot_cache.STATE_DIR, name + '.spool')
+        self.keys = config_keys(config)
+        self.index = {k: i for i, k in enumerate(self.keys)}
+        self.khash = zlib.crc32('\n'.join(f'{g}.{f}' for g, f in self.keys).encode())
+        self.slots = slots
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            magic, khash, slots, head, tail = HDR.unpack(f.read(HDR.size).ljust(HDR.size, b'\0'))
+            if (magic, khash, slots) != (MAGIC, self.khash, self.slots):
+                # New file, or the plugin's fields changed: start over
+                f.truncate(0)
+                head = tail = 0
+            ptr = [head, tail]
+            yield f, ptr
+            f.seek(0)
+            f.write(HDR.pack(MAGIC, self.khash, self.slots, ptr[0], ptr[1]))
+
+    def append(self, epoch, values):
+        """Record one sample; values are (multigraph, field, value) triples"""
+        recs = [REC.pack(epoch, self.index[(g, fld)], v)
+                for g, fld, v in values if (g, fld) in self.index]
+        with self._locked() as (f, ptr):
+            head, tail = ptr
+            if head + len(recs) - tail > self.slots:
+                # Ring full: drop the oldest samples whole, so a drained epoch
+                # never has only some of its fields
+                tail = head + len(recs) - self.slots
+                if tail < head:
+                    dropped = self._epoch(f, tail - 1)
+                    while tail < head and self._epoch(f, tail) == dropped:
+                        tail += 1
+                ptr[1] = tail
+            for rec in recs:
+                f.seek(HDR.size + (ptr[0] % self.slots) * REC.size)
+                f.write(rec)
+                ptr[0] += 1
+
+    def _epoch(self, f, i):
+        f.seek(HDR.size + (i % self.slots) * REC.size)
+        return REC.unpack(f.read(REC.size))[0]
+
+    def drain(self):
+        """Remove and return all spooled (epoch, field index, value) records"""
+        with self._locked() as (f, ptr):
+            head, tail = ptr
+            recs = []
+            for i in range(tail, head):
+                f.seek(HDR.size + (i % self.slots) * REC.size)
+                recs.append(REC.unpack(f.read(REC.size)))
+            ptr[1] = head
+        return recs
+
+
+def capture(fetch, *args, **kwargs):
+    """Run a plugin fetch function, returning its values as (multigraph, field, value)"""
+    buf = io.StringIO()
+    with contextlib.redirect_stdout(buf):
+        fetch(*args, **kwargs)
+    values = []
+    graph = None
+    for line in buf.getvalue().splitlines():
+        if line.startswith('multigraph '):
+            graph = line.split(None, 1)[1].strip()
+        elif '.value ' in line:
+            field, value = line.split('.value ', 1)
+            try:
+                values.append((graph, field, float(value)))
+            except ValueError:
+                values.append((graph, field, math.nan))
+    return values
+
+
+def spool_fetch(spool):
+    """Print spooled records as Munin fetch output; False if there were none"""
+    try:
+        recs = spool.drain()
+    except OSError as e:
+        # State directory missing or not ours: the caller does a live fetch
+        print(f"{spool.path}: {e}", file=sys.stderr)
+        return False
+    if not recs:
+        return False
+    by_key = {}
+    for epoch, i, v in recs:
+        by_key.setdefault(i, []).append((epoch, v))
+    graph = None
+    for i, (g, field) in enumerate(spool.keys):
+        if i not in by_key:
+            continue
+        if g != graph:
+            print(f'multigraph {g}')
+            graph = g
+        for epoch, v in sorted(by_key[i]):
+            print(f"{field}.value {epoch}:{'U' if math.isnan(v) else f'{v:.10g}'}")
+    return True
+
+
+def spool_run(jobs, interval):
+    """Sample forever; jobs are (spool, fetch, args) tuples sampled every interval seconds"""
+    while True:
+        time.sleep(interval - time.time() % interval)
+        epoch = int(round(time.time()))
+        for spool, fetch, args in jobs:
+            try:
+                spool.append(epoch, capture(fetch, *args))
+            except Exception as e:
+                print(f"{spool.path}: sample failed: {e}", file=sys.stderr)
+
+
+def main(spool_or_jobs, interval, fetch):
+    """Plugin entry point for everything but `config`
+
+    `<plugin> spool` samples spool_or_jobs (a Spool sampled with fetch, or a
+    list of spool_run jobs) forever. Any other run drains the Spool, falling
+    back to a live fetch() if spooling is off or the sampler hasn't run since
+    the last fetch."""
+    if len(sys.argv) > 1 and sys.argv[1] == 'spool':
+        if not interval:
+            print("Set SPOOL_INTERVAL to enable spool mode", file=sys.stderr)
+            sys.exit(1)
+        if isinstance(spool_or_jobs, Spool):
+            spool_or_jobs = [(spool_or_jobs, fetch, ())]
+        spool_run(spool_or_jobs, interval)
+    elif not (interval and spool_fetch(spool_or_jobs)):
+        fetch()
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+# OpenMetrics/Prometheus exporter for the ADS-B and SDR Munin plugins
+#
+# Serves the fetch output of dump1090.py, adsb_multi.py and sdr_monitor.py on
+# http://LISTEN:PORT/metrics. Each Munin graph becomes a gauge family with one
+# `field` label per Munin field; DERIVE/COUNTER fields go to a counter family
+# (samples named <graph>_total) so that rate() applies. Values come from a
+# cached snapshot: a plugin's fetch is re-run only when the files it reads have
+# changed (or after MAX_AGE seconds, for sources such as ps/dmesg that have no
+# file to watch), and concurrent scrapes wait for and share a single
+# recomputation.
+
+import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import os
+import re
+import sys
+import threading
+import time
+
+import adsb_multi
+import dump1090
+import munin_spool
+import readsb_history
+import sdr_monitor
+
+# --- Configuration begins ---
+LISTEN = '127.0.0.1'
+PORT = 9911
+
+# Plugins with no files to watch (ps/dmesg based) are re-run this often
+MAX_AGE = 60
+# --- Configuration ends ---
+
+
+def dump1090_watch(which):
+    if which == 'ac':
+        if dump1090.HISTORY_DATA:
+            return [dump1090.RECVR_FILE] + readsb_history.history_files(dump1090.HISTORY_DATA)
+        return [dump1090.RECVR_FILE] + glob.glob(os.path.join(dump1090.JSON_DATA, 'history_*.json'))
+    return [dump1090.STATS_FILE]
+
+
+def adsb_multi_watch(which):
+    if which == 'cpu':
+        # Falls back to ps whenever stats.json has no CPU figures
+        return []
+    paths = []
+    for tech, path in adsb_multi.DATA_SOURCES.items():
+        if which == 'ac':
+            paths.append(os.path.join(path, 'receiver.json'))
+            if tech in adsb_multi.HISTORY_SOURCES:
+                paths += readsb_history.history_files(adsb_multi.HISTORY_SOURCES[tech])
+            else:
+                paths += glob.glob(os.path.join(path, 'history_*.json'))
+        else:
+            paths.append(os.path.join(path, 'stats.json'))
+    return paths
+
+
+class Collector(object):
+    """One plugin fetch, its Munin config, and the cached values it last produced"""
+    def __init__(self, name, fetch, args, config, watch):
+        self.name = name
+        self.fetch = fetch
+        self.args = args
+        self.watch = watch
+        self.titles = config_titles(config, name)
+        self.counters = config_counters(config, name)
+        self.signature = None
+        self.updated = 0
+        self.values = []
+
+    def current_signature(self):
+        sig = []
+        for path in sorted(self.watch()):
+            try:
+                st = os.stat(path)
+                sig.append((path, st.st_mtime_ns, st.st_ino))
+            except OSError:
+                sig.append((path, None, None))
+        return tuple(sig)
+
+    def refresh(self):
+        """Re-run the fetch if stale. Returns True if values were recomputed."""
+        sig = self.current_signature()
+        if sig == self.signature and (sig or time.time() - self.updated < MAX_AGE):
+            return False
+        try:
+            self.values = munin_spool.capture(self.fetch, *self.args)
+        except Exception as e:
+            print(f"{self.name}: fetch failed: {e}", file=sys.stderr)
+            self.values = []
+            sig = None
+        self.signature = sig
+        self.updated = time.time()
+        return True
+
+
+def config_titles(config, default):
+    """Map each graph in a Munin config text to its graph_title"""
+    titles = {}
+    graph = None
+    for line in config.splitlines():
+        if line.startswith('multigraph '):
+            graph = line.split(None, 1)[1].strip()
+        elif line.startswith('graph_title '):
+            titles[graph or default] = line.split(None, 1)[1].strip()
+    return titles
+
+
+def config_counters(config, default):
+    """(graph, field) pairs a Munin config declares as DERIVE or COUNTER"""
+    counters = set()
+    graph = None
+    for line in config.splitlines():
+        if line.startswith('multigraph '):
+            graph = line.split(None, 1)[1].strip()
+        elif '.type ' in line and line.split()[-1] in ('DERIVE', 'COUNTER'):
+            counters.add((graph or default, line.split('.', 1)[0]))
+    return counters
+
+
+def metric_name(graph):
+    return re.sub(r'[^a-zA-Z0-9_:]', '_', graph)
+
+
+def render(collectors, openmetrics):
+    """Render all cached values in OpenMetrics (or Prometheus 0.0.4) text format"""
+    families = {}
+    for c in collectors:
+        for graph, field, value in c.values:
+            graph = graph or c.name
+            kind = 'counter' if (graph, field) in c.counters else 'gauge'
+            fam = families.setdefault((metric_name(graph), kind), (c.titles.get(graph, graph), []))
+            fam[1].append((field, value))
+
+    out = []
+    for (name, kind), (title, samples) in families.items():
+        title = title.replace('\\', '\\\\').replace('\n', '\\n')
+        sample_name = name
+        if kind == 'counter':
+            # A graph mixing gauges and counters needs two distinct family names
+            if (name, 'gauge') in families:
+                name += '_count'
+            sample_name = name + '_total'
+            # OpenMetrics names the family without the suffix, 0.0.4 with it
+            if not openmetrics:
+                name = sample_name
+        out.append(f'# TYPE {name} {kind}\n')
+        out.append(f'# HELP {name} {title}\n')
+        for field, value in samples:
+            out.append(f'{sample_name}{{field="{field}"}} {"NaN" if math.isnan(value) else repr(value)}\n')
+    if openmetrics:
+        out.append('# EOF\n')
+    return ''.join(out)
+
+
+COLLECTORS = (
+    [Collector(f'dump1090_{which}', dump1090.do_fetch, (which,), config,
+               lambda which=which: dump1090_watch(which))
+     for which, config in dump1090.CONFIG.items()] +
+    [Collector(f'adsb_{which}', adsb_multi.do_fetch, (which,), config,
+               lambda which=which: adsb_multi_watch(which))
+     for which, config in adsb_multi.CONFIG.items()] +
+    [Collector('sdr_monitor', sdr_monitor.do_fetch, (), sdr_monitor.CONFIG, lambda: [])]
+)
+
+lock = threading.Lock()
+cache = {True: None, False: None}
+
+def snapshot(openmetrics):
+    """Current exposition text, recomputing stale collectors at most once per change"""
+    # Holding the lock both coalesces concurrent scrapes and serialises the
+    # fetches, which print to the (process-global) redirected stdout
+    with lock:
+        changed = False
+        for c in COLLECTORS:
+            changed |= c.refresh()
+        if changed:
+            cache[True] = cache[False] = None
+        if cache[openmetrics] is None:
+            cache[openmetrics] = render(COLLECTORS, openmetrics).encode()
+        return cache[openmetrics]
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = snapshot(openmetrics)
+        self.send_response(200)
+        if openmetrics:
+            self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        else:
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    server = ThreadingHTTPServer((LISTEN, PORT), MetricsHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+# Streaming reader for readsb/tar1090 aircraft history
+#
+# tar1090 keeps history as gzip-compressed `chunk_*.gz` / `current_*.gz` files,
+# each holding {"files": [<aircraft.json snapshot>, ...]} with aircraft packed
+# as arrays; readsb can also write `*.binCraft` snapshots (fixed-stride binary
+# records, optionally gzipped). Both are decoded incrementally, a block at a
+# time, and yielded as (now, aircraft) in dump1090-fa's history_N.json shape so
+# the plugins can feed them to the same aggregation.
+
+import codecs
+import glob
+import json
+import math
+import os
+import struct
+import sys
+import zlib
+
+BLOCK = 64 << 10
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Field order of tar1090's compact history aircraft arrays
+COMPACT_FIELDS = ('hex', 'alt_baro', 'gs', 'track', 'lat', 'lon', 'seen_pos', 'type', 'flight', 'messages', 'rssi')
+
+# binCraft: header is now (ms, two u32 halves) then record stride; each record
+# starts with addr, seen_pos, seen, lon, lat, baro_rate, geom_rate, baro_alt, geom_alt
+BC_HDR = struct.Struct('<III')
+BC_REC = struct.Struct('<IHHiihhhh')
+BC_MESSAGES = 62 # u16
+BC_AIRGROUND = 68 # low nibble: 1 = ground
+BC_VALID = 73 # bit 4 baro alt, 5 geom alt, 6 position
+BC_RSSI = 86 # u8, sqrt-scaled
+BC_MIN_STRIDE = 88
+
+
+def history_files(path):
+    """Compressed history files under path, oldest first"""
+    files = []
+    try:
+        with open(os.path.join(path, 'chunks.json')) as f:
+            files = [os.path.join(path, c) for c in json.load(f)['chunks']]
+    except (OSError, ValueError, KeyError, TypeError):
+        files = glob.glob(os.path.join(path, 'chunk_*.gz')) + glob.glob(os.path.join(path, 'current_*.gz'))
+    files += glob.glob(os.path.join(path, '*.binCraft')) + glob.glob(os.path.join(path, '*.binCraft.gz'))
+    mtimes = {}
+    for fn in files:
+        try:
+            mtimes[fn] = os.path.getmtime(fn)
+        except OSError:
+            pass
+    return sorted(mtimes, key=mtimes.get)
+
+
+def iter_blocks(fn):
+    """Yield the contents of fn a block at a time, gunzipping (multi-member) gzip on the fly"""
+    with open(fn, 'rb') as f:
+        block = f.read(BLOCK)
+        if not block.startswith(GZIP_MAGIC):
+            while block:
+                yield block
+                block = f.read(BLOCK)
+            return
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while block:
+            while block:
+                out = d.decompress(block)
+                if out:
+                    yield out
+                if d.eof:
+                    block = d.unused_data
+                    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    block = b''
+            block = f.read(BLOCK)
+        out = d.flush()
+        if out:
+            yield out
+
+
+def iter_chunk(blocks):
+    """Yield each snapshot of a tar1090 chunk's "files" array as soon as it is complete"""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    in_files = False
+    for block in blocks:
+        buf = buf[pos:] + text.decode(block)
+        pos = 0
+        if not in_files:
+            i = buf.find('"files"')
+            j = buf.find('[', i) if i >= 0 else -1
+            if j < 0:
+                continue
+            pos = j + 1
+            in_files = True
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == ']':
+                return
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Snapshot continues in the next block
+                break
+            yield obj
+    if in_files and buf[pos:].strip():
+        raise ValueError('truncated history chunk')
+
+
+def expand(ac):
+    """tar1090 compact aircraft array -> aircraft.json style dict"""
+    if not isinstance(ac, list):
+        return ac
+    return {k: v for k, v in zip(COMPACT_FIELDS, ac) if v is not None}
+
+
+def read_bincraft(blocks):
+    """Decode a binCraft snapshot record by record. Returns (now, aircraft)."""
+    buf = b''
+    now = stride = None
+    in_header = True
+    aircraft = []
+    for block in blocks:
+        buf += block
+        if stride is None:
+            if len(buf) < BC_HDR.size:
+                continue
+            now_lo, now_hi, stride = BC_HDR.unpack_from(buf)
+            now = now_lo / 1000.0 + now_hi * 4294967.296
+            if stride < BC_MIN_STRIDE:
+                raise ValueError(f'unsupported binCraft stride {stride}')
+        # The header is padded to one record
+        if in_header:
+            if len(buf) < stride:
+                continue
+            buf = buf[stride:]
+            in_header = False
+        n = len(buf) // stride
+        for i in range(n):
+            aircraft.append(bincraft_record(buf, i * stride))
+        buf = buf[n * stride:]
+    if now is None:
+        raise ValueError('empty binCraft file')
+    return now, aircraft
+
+
+def bincraft_record(buf, off):
+    addr, seen_pos, seen, lon, lat, _, _, baro_alt, geom_alt = BC_REC.unpack_from(buf, off)
+    valid = buf[off + BC_VALID]
+    ac = {
+        'hex': ('~' if addr & (1 << 24) else '') + '%06x' % (addr & 0xffffff),
+        'seen': seen / 10.0,
+        'messages': struct.unpack_from('<H', buf, off + BC_MESSAGES)[0],
+    }
+    if buf[off + BC_AIRGROUND] & 15 == 1:
+        ac['alt_baro'] = 'ground'
+    elif valid & 16:
+        ac['alt_baro'] = baro_alt * 25
+    if valid & 32:
+        ac['alt_geom'] = geom_alt * 25
+    if valid & 64:
+        ac['lat'] = lat / 1e6
+        ac['lon'] = lon / 1e6
+        ac['seen_pos'] = seen_pos / 10.0
+    rssi = buf[off + BC_RSSI]
+    ac['rssi'] = 10 * math.log10(rssi * rssi / 65025.0 + 1.125e-5)
+    return ac
+
+
+def iter_history(path, since=0):
+    """Yield (now, aircraft) for every snapshot under path newer than since
+
+    Files last written at or before since hold nothing newer, so they are
+    skipped unread; snapshots present in more than one file (tar1090's
+    current_* files overlap) are yielded once."""
+    seen = set()
+    for fn in history_files(path):
+        try:
+            if os.path.getmtime(fn) <= since:
+                continue
+            if '.binCraft' in fn:
+                snapshots = [read_bincraft(iter_blocks(fn))]
+            else:
+                snapshots = ((d['now'], d['aircraft']) for d in iter_chunk(iter_blocks(fn)))
+            for now, aircraft in snapshots:
+                if now <= since or now in seen:
+                    continue
+                seen.add(now)
+                yield now, [expand(ac) for ac in aircraft]
+        except (OSError, ValueError, KeyError, zlib.error) as e:
+            # tar1090 rotates chunks underneath us; skip what we can't read
+            print(f"{fn}: {e}", file=sys.stderr)
@@ -1,10 +1,34 @@
 #!/usr/bin/python3
+import munin_spool
 import os
 import sys
 import subprocess
 
 PROCESS_NAME = "java"
 
+# Spool mode: sample every SPOOL_INTERVAL seconds (0 disables) via a
+# separately run `sdr_monitor.py spool`; fetches then drain the spool.
+# See munin_spool.py before enabling it on an existing install.
+SPOOL_INTERVAL = 0
+SPOOL_SLOTS = 16384
+
+CONFIG = """\
+multigraph sdr_resources
+graph_title SDRTrunk CPU & Memory
+graph_category radio
+graph_vlabel % / MB
+cpu.label CPU Usage (%)
+mem.label RAM Usage (MB)
+multigraph sdr_usb
+graph_title SDR USB Stability
+graph_category radio
+graph_vlabel events
+disc.label Disconnects
+disc.type DERIVE
+pwr.label Power Sags
+pwr.type DERIVE
+"""
+
 def get_stats():
     # Resource Stats
     try:
@@ -21,35 +45,29 @@ def get_stats():
         pwr = subprocess.check_output("dmesg | grep -Ei 'over-current|power-off|vbus|babble' | wc -l", shell=True).decode().strip()
     except:
         disc, pwr = 0, 0
-        
+
     return cpu, mem, disc, pwr
 
-if len(sys.argv) > 1 and sys.argv[1] == 'config':
-    # Graph 1: Resources
+def do_config():
+    # Graph 1: Resources; Graph 2: USB Stability (separate scale for small error counts)
+    if SPOOL_INTERVAL:
+        print(munin_spool.spool_config(CONFIG, SPOOL_INTERVAL), end='')
+    else:
+        print(CONFIG, end='')
+
+def do_fetch():
+    cpu, mem, disc, pwr = get_stats()
+
     print("multigraph sdr_resources")
-    print("graph_title SDRTrunk CPU & Memory")
-    print("graph_category radio")
-    print("graph_vlabel % / MB")
-    print("cpu.label CPU Usage (%)")
-    print("mem.label RAM Usage (MB)")
-    
-    # Graph 2: USB Stability (Separate scale for small error counts)
+    print(f"cpu.value {cpu}")
+    print(f"mem.value {mem}")
+
     print("multigraph sdr_usb")
-    print("graph_title SDR USB Stability")
-    print("graph_category radio")
-    print("graph_vlabel events")
-    print("disc.label Disconnects")
-    print("disc.type DERIVE")
-    print("pwr.label Power Sags")
-    print("pwr.type DERIVE")
-    sys.exit(0)
-
-cpu, mem, disc, pwr = get_stats()
-
-print("multigraph sdr_resources")
-print(f"cpu.value {cpu}")
-print(f"mem.value {mem}")
-
-print("multigraph sdr_usb")
-print(f"disc.value {disc}")
-print(f"pwr.value {pwr}")
+    print(f"disc.value {disc}")
+    print(f"pwr.value {pwr}")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'config':
+        do_config()
+    else:
+        munin_spool.main(munin_spool.Spool('sdr_monitor', CONFIG, SPOOL_SLOTS), SPOOL_INTERVAL, do_fetch)
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+# Plugin state directory helpers and shared parsed-JSON cache
+#
+# STATE_DIR and atomic_write() are used by every plugin that keeps state.
+#
+# munin-node runs the dump1090_* wildcard plugins (and adsb_multi instances)
+# back to back, each decoding the same stats.json/receiver.json. load_json()
+# keeps the decoded object in the plugin state directory in marshal form,
+# keyed by the source's mtime, inode and size, so a cluster of fetches parses
+# each source once. Cache files are replaced atomically; a miss takes a
+# per-source lock so concurrent misses wait for one parse instead of racing.
+#
+# This and the other helper modules (munin_spool, readsb_history) are imported
+# from the plugins' own directory; Python resolves the plugin symlink in
+# /etc/munin/plugins when setting up sys.path, so they only need to sit next to
+# the plugin files.
+
+import fcntl
+import json
+import marshal
+import os
+import tempfile
+import time
+import zlib
+
+STATE_DIR = os.environ.get('MUNIN_PLUGSTATE', '/var/lib/munin-node/plugin-state/nobody')
+
+# Entries older than this are re-parsed even if the source looks unchanged
+CACHE_TTL = 60
+
+MISS = object()
+
+
+def cache_file(path):
+    path = os.path.abspath(path)
+    return os.path.join(STATE_DIR, 'json-%s-%08x.marshal' % (os.path.basename(path), zlib.crc32(path.encode())))
+
+
+def source_key(st):
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+
+def read_cache(cfn, key):
+    try:
+        with open(cfn, 'rb') as f:
+            ckey, saved, data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return MISS
+    if ckey != key or time.time() - saved > CACHE_TTL:
+        return MISS
+    return data
+
+
+def atomic_write(fn, content):
+    """Replace fn with content (str or bytes) so readers never see a partial file"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as f:
+            # mkstemp creates 0600; state such as the coverage dump is read by other users
+            os.fchmod(f.fileno(), 0o644)
+            f.write(content)
+        os.replace(tmp, fn)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def write_cache(cfn, key, data):
+    try:
+        atomic_write(cfn, marshal.dumps((key, time.time(), data)))
+    except (OSError, ValueError):
+        pass
+
+
+def load_json(path):
+    """json.load() the file at path, via the shared cache where possible"""
+    cfn = cache_file(path)
+    key = source_key(os.stat(path))
+    data = read_cache(cfn, key)
+    if data is not MISS:
+        return data
+
+    try:
+        lock = open(cfn + '.lock', 'a')
+    except OSError:
+        # State directory unavailable: behave like a plain json.load
+        with open(path) as f:
+            return json.load(f)
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Another fetch may have parsed it while we waited for the lock
+        data = read_cache(cfn, key)
+        if data is not MISS:
+            return data
+        with open(path) as f:
+            # Key on what was actually read, in case the source was replaced meanwhile
+            key = source_key(os.fstat(f.fileno()))
+            data = json.load(f)
+        write_cache(cfn, key, data)
+        return data